@@ -7,7 +7,7 @@ from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from langchain_google_genai import ChatGoogleGenerativeAI
 from dotenv import load_dotenv
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 import sys
 import threading
 from functools import lru_cache
@@ -17,6 +17,10 @@ import time
 from concurrent.futures import ThreadPoolExecutor
 import logging
 import re
+import heapq
+import secrets
+import contextlib
+from collections import Counter, OrderedDict, deque
 
 # Оптимизированная настройка логирования
 logging.basicConfig(
@@ -167,9 +171,13 @@ class OptimizedKnowledgeCache:
         
         return index
     
-    def _update_cache(self) -> None:
+    def _update_cache(self, stages: Optional[Dict[str, float]] = None) -> None:
         """Обновляет кеш базы знаний если исходные файлы были изменены."""
+        wait_start = time.perf_counter()
         with self._lock:
+            if stages is not None:
+                # Время ожидания блокировки показывает конкуренцию между запросами
+                stages["kb_lock_wait"] = stages.get("kb_lock_wait", 0.0) + time.perf_counter() - wait_start
             mtime = self._get_latest_mtime()
             if mtime == self._last_mtime and self._content:
                 return
@@ -200,14 +208,12 @@ class OptimizedKnowledgeCache:
             self._last_mtime = mtime
 
             load_time = time.time() - start_time
+            if stages is not None:
+                stages["kb_reload"] = load_time
             logger.info(f"Кеш базы знаний обновлен за {load_time:.2f}с, размер: {len(content)} символов")
     
-    def get_relevant_sections(self, query: str) -> str:
-        """Извлекает релевантные разделы знаний по запросу."""
-        self._update_cache()
-        if not self._content:
-            return ""
-            
+    def _find_sections(self, query: str) -> set:
+        """Находит названия разделов, ключевые слова которых встречаются в запросе."""
         # Извлекаем ключевые слова из запроса
         keywords = set(re.findall(r'\b\w+\b', query.lower()))
         relevant_sections = set()
@@ -216,6 +222,19 @@ class OptimizedKnowledgeCache:
         for keyword in keywords:
             if len(keyword) > 3 and keyword in self._section_index:
                 relevant_sections.update(self._section_index[keyword])
+        return relevant_sections
+    
+    def has_relevant_sections(self, query: str) -> bool:
+        """Проверяет по индексу, упоминает ли запрос какой-либо раздел базы знаний."""
+        return bool(self._find_sections(query))
+    
+    def get_relevant_sections(self, query: str, stages: Optional[Dict[str, float]] = None) -> str:
+        """Извлекает релевантные разделы знаний по запросу."""
+        self._update_cache(stages)
+        if not self._content:
+            return ""
+            
+        relevant_sections = self._find_sections(query)
         
         # Если не нашли релевантных разделов, возвращаем весь контент
         if not relevant_sections:
@@ -234,9 +253,9 @@ class OptimizedKnowledgeCache:
             
         return "\n\n".join(result)
     
-    def get(self) -> Tuple[str, str]:
+    def get(self, stages: Optional[Dict[str, float]] = None) -> Tuple[str, str]:
         """Возвращает полное содержимое базы знаний и его хеш."""
-        self._update_cache()
+        self._update_cache(stages)
         return self._content, self._content_hash
 
 
@@ -257,7 +276,7 @@ PROMPT = """
 База знаний:
 {document_content}
 
-Вопрос: {user_query}
+{history_block}Вопрос: {user_query}
 
 Ответ:
 """
@@ -320,10 +339,13 @@ response_cache: Dict[str, Tuple[str, float]] = {}
 CACHE_TTL = 300  # 5 минут
 MAX_CACHE_SIZE = 200  # Максимальное количество элементов в кеше
 
-def get_cache_key(query: str, content_hash: str) -> str:
+def get_cache_key(query: str, content_hash: str, history: str = "") -> str:
     """Генерация ключа для кеша."""
     # Нормализуем запрос для лучшего совпадения кеша
     normalized_query = re.sub(r'\s+', ' ', query.lower().strip())
+    # Самостоятельные вопросы (без истории) используют общий ключ для всех сессий
+    if history:
+        normalized_query = f"{normalized_query}:{hashlib.md5(history.encode()).hexdigest()}"
     return hashlib.md5(f"{normalized_query}:{content_hash}".encode()).hexdigest()
 
 def is_cache_valid(timestamp: float) -> bool:
@@ -349,18 +371,27 @@ def cleanup_cache() -> None:
         for i in range(to_remove):
             del response_cache[sorted_items[i][0]]
 
-def cached_ai_answer(document_content: str, content_hash: str, user_query: str, api_key: Optional[str] = None) -> str:
-    """Получение ответа AI с кешированием для повторяющихся запросов."""
+def cached_ai_answer(document_content: str, content_hash: str, user_query: str, api_key: Optional[str] = None,
+                     stages: Optional[Dict[str, float]] = None, submitted_at: Optional[float] = None,
+                     history: str = "") -> Tuple[str, bool]:
+    """Получение ответа AI с кешированием для повторяющихся запросов.
+
+    Возвращает текст ответа и признак успешной генерации.
+    """
+    if stages is not None and submitted_at is not None:
+        # Время в очереди пула потоков показывает насыщение executor
+        stages["executor_wait"] = time.perf_counter() - submitted_at
+
     # Предобработка запроса
     processed_query = preprocess_query(user_query)
-    cache_key = get_cache_key(processed_query, content_hash)
+    cache_key = get_cache_key(processed_query, content_hash, history)
 
     # Проверяем кеш
     if cache_key in response_cache:
         cached_response, timestamp = response_cache[cache_key]
         if is_cache_valid(timestamp):
             logger.info(f"Найден кеш для запроса: {user_query[:50]}...")
-            return cached_response
+            return cached_response, True
 
     # Генерируем новый ответ
     start_time = time.time()
@@ -368,59 +399,439 @@ def cached_ai_answer(document_content: str, content_hash: str, user_query: str,
     try:
         llm = llm_manager.get_llm(api_key)
         
-        # Формируем промпт с релевантным контентом
-        prompt = PROMPT.format(document_content=document_content, user_query=user_query)
+        # Формируем промпт с релевантным контентом; история идет после базы знаний,
+        # чтобы неизменная часть промпта оставалась общим префиксом
+        history_block = f"История диалога:\n{history}\n\n" if history else ""
+        prompt = PROMPT.format(document_content=document_content, history_block=history_block, user_query=user_query)
         
         # Получаем ответ от модели
+        llm_start = time.perf_counter()
         response = llm.invoke(prompt)
+        if stages is not None:
+            stages["llm"] = time.perf_counter() - llm_start
         content = response.content.strip() if hasattr(response, "content") else str(response).strip()
         
         # Проверяем на пустые или слишком короткие ответы
-        if not content or len(content) < 10:
+        success = bool(content) and len(content) >= 10
+        if not success:
             content = "Извините, я не смог сформировать ответ на основе имеющейся информации."
             
-        # Сохраняем в кеш
-        response_cache[cache_key] = (content, time.time())
-        
-        # Очищаем старые записи из кеша
-        cleanup_cache()
+        # Сохраняем в кеш только полноценные ответы, чтобы повтор вопроса вызвал новую генерацию
+        if success:
+            response_cache[cache_key] = (content, time.time())
+            
+            # Очищаем старые записи из кеша
+            cleanup_cache()
         
         response_time = time.time() - start_time
         logger.info(f"Ответ AI сгенерирован за {response_time:.2f}с для запроса: {user_query[:50]}...")
         
-        return content
+        return content, success
     except Exception as e:
         logger.error(f"Ошибка генерации ответа AI: {str(e)}")
-        return f"Произошла ошибка при обработке вашего запроса: {str(e)}"
+        return f"Произошла ошибка при обработке вашего запроса: {str(e)}", False
+
 
+async def get_ai_answer_async(user_query: str, api_key: Optional[str] = None,
+                              stages: Optional[Dict[str, float]] = None,
+                              history: str = "", search_query: Optional[str] = None) -> Tuple[str, bool]:
+    """Асинхронная обработка AI запроса с оптимизацией производительности.
 
-async def get_ai_answer_async(user_query: str, api_key: Optional[str] = None) -> str:
-    """Асинхронная обработка AI запроса с оптимизацией производительности."""
+    Возвращает текст ответа и признак успешной генерации.
+    """
     # Получаем базу знаний и ее хеш
-    full_content, content_hash = knowledge_cache.get()
+    stage_start = time.perf_counter()
+    full_content, content_hash = knowledge_cache.get(stages)
     
     # Получаем только релевантные разделы для запроса
-    relevant_content = knowledge_cache.get_relevant_sections(user_query)
+    relevant_content = knowledge_cache.get_relevant_sections(search_query or user_query, stages)
+    if stages is not None:
+        # Поиск разделов выполняется в event loop и блокирует его
+        stages["knowledge"] = time.perf_counter() - stage_start
     content_to_use = relevant_content or full_content
     
     if not content_to_use or not content_to_use.strip():
-        return "База знаний пуста или не загружена. Обратитесь к администратору."
+        return "База знаний пуста или не загружена. Обратитесь к администратору.", False
 
     try:
         # Выполняем AI запрос в отдельном потоке для неблокирующей работы
         loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(
+        return await loop.run_in_executor(
             executor,
             cached_ai_answer,
             content_to_use,
             content_hash,
             user_query,
-            api_key
+            api_key,
+            stages,
+            time.perf_counter(),
+            history
         )
-        return result
     except Exception as e:
         logger.error(f"Ошибка AI: {str(e)}")
-        return f"Произошла ошибка при обработке вашего запроса. Пожалуйста, повторите попытку позже или обратитесь к администратору системы."
+        return f"Произошла ошибка при обработке вашего запроса. Пожалуйста, повторите попытку позже или обратитесь к администратору системы.", False
+
+
+# Параметры сессий диалога
+SESSION_TTL = int(os.getenv("TOU_SESSION_TTL", "1800"))  # Время жизни неактивной сессии в секундах
+MAX_SESSIONS = int(os.getenv("TOU_MAX_SESSIONS", "1000"))  # Максимальное количество сессий в памяти
+SESSION_RECENT_TURNS = 3  # Сколько последних реплик хранить дословно
+HISTORY_TOKEN_BUDGET = 600  # Бюджет токенов на историю диалога в промпте
+SUMMARY_TOKEN_BUDGET = 200  # Часть бюджета, зарезервированная под резюме старых реплик
+MAX_TURN_QUESTION_LENGTH = 200  # Максимальная длина вопроса, сохраняемого в истории
+MAX_TURN_ANSWER_LENGTH = 400  # Максимальная длина последнего ответа, сохраняемого в истории
+OLDER_TURN_ANSWER_LENGTH = 150  # До какой длины сокращаются более ранние ответы при нехватке бюджета
+MAX_SUMMARY_LINE_LENGTH = 120  # Максимальная длина строки краткого резюме
+
+# Признаки уточняющего вопроса, который не имеет смысла без предыдущего контекста
+FOLLOWUP_LEADING_PATTERN = re.compile(r'^(а|и|но|ещё|еще|также|тоже)\b')
+FOLLOWUP_PRONOUNS = {
+    "это", "этот", "эта", "эти", "этого", "этой", "этом", "этим", "том", "там", "туда", "тут", "здесь",
+    "он", "она", "оно", "они", "его", "её", "ее", "их", "него", "неё", "нее", "нем", "нём", "ней", "ним",
+    "ними", "них", "им", "ему", "такой", "такая", "такие",
+}
+# Слова, которые не несут темы вопроса
+QUESTION_STOPWORDS = {
+    "какие", "какой", "какая", "каких", "когда", "сколько", "куда", "откуда", "почему", "зачем", "есть",
+    "можно", "нужно", "расскажи", "скажи", "подскажи", "покажи", "помоги", "пожалуйста", "также", "тоже",
+}
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка количества токенов (кириллица в среднем ~3 символа на токен)."""
+    return len(text) // 3 + 1
+
+
+def is_followup_question(question: str, has_topic: bool = False) -> bool:
+    """Определяет, зависит ли вопрос от контекста предыдущих реплик.
+
+    has_topic означает, что сам вопрос находит разделы в базе знаний; такой вопрос
+    считается самостоятельным и использует общий кеш ответов.
+    """
+    if has_topic:
+        return False
+    normalized = re.sub(r'\s+', ' ', question.strip().lower())
+    if FOLLOWUP_LEADING_PATTERN.search(normalized):
+        return True
+    words = re.findall(r'\w+', normalized)
+    # Слишком короткий вопрос почти всегда продолжает предыдущий
+    if len([word for word in words if len(word) >= 3]) < 2:
+        return True
+    # Местоимение указывает на предыдущую реплику, только если в вопросе нет своей темы;
+    # «что это» / «кто это» относятся к тому, что названо в самом вопросе
+    pronouns = [word for i, word in enumerate(words) if word in FOLLOWUP_PRONOUNS
+                and not (word == "это" and i > 0 and words[i - 1] in ("что", "кто"))]
+    content_words = [word for word in words
+                     if len(word) >= 4 and word not in QUESTION_STOPWORDS and word not in FOLLOWUP_PRONOUNS]
+    return bool(pronouns) and len(content_words) < 2
+
+
+class ConversationSession:
+    """Сжатая история диалога: краткое резюме старых реплик и несколько последних."""
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.summary = []  # Строки резюме вытесненных реплик
+        self.turns = deque()  # Последние реплики (вопрос, ответ, тема для поиска разделов)
+        self.last_access = time.time()
+        self.lock = asyncio.Lock()
+
+    @staticmethod
+    def _shorten(text: str, limit: int) -> str:
+        return text if len(text) <= limit else text[:limit] + "..."
+
+    @staticmethod
+    def _plain_text(answer: str) -> str:
+        """Убирает маркеры списков и разметку markdown, склеивая ответ в одну строку."""
+        text = re.sub(r'^\s*(?:#+|[-*•]|\d+[.)])\s+', '', answer, flags=re.MULTILINE)
+        text = re.sub(r'\*\*|__|[*`]', '', text)
+        return re.sub(r'\s+', ' ', text).strip()
+
+    @classmethod
+    def _summarize_turn(cls, question: str, answer: str) -> str:
+        """Сжимает реплику до одной строки: вопрос и начало ответа (не короче 40 символов)."""
+        summary = ""
+        for sentence in re.split(r'(?<=[.!?])\s+', cls._plain_text(answer)):
+            summary = f"{summary} {sentence}".strip()
+            if len(summary) >= 40:
+                break
+        return cls._shorten(f"- {question.strip()} → {summary}", MAX_SUMMARY_LINE_LENGTH)
+
+    def _fold_oldest_turn(self) -> None:
+        """Переносит самую старую дословную реплику в резюме."""
+        question, answer, _ = self.turns.popleft()
+        self.summary.append(self._summarize_turn(question, answer))
+
+    def add_turn(self, question: str, answer: str, topic: Optional[str] = None) -> None:
+        """Добавляет реплику и вытесняет старые в резюме, соблюдая бюджет токенов.
+
+        topic — запрос, по которому ищутся разделы базы знаний; для самостоятельного
+        вопроса это сам вопрос, уточняющие вопросы наследуют тему предыдущей реплики.
+        """
+        question = self._shorten(question.strip(), MAX_TURN_QUESTION_LENGTH)
+        self.turns.append((question, self._shorten(answer.strip(), MAX_TURN_ANSWER_LENGTH), topic or question))
+        while len(self.turns) > SESSION_RECENT_TURNS:
+            self._fold_oldest_turn()
+
+        # Дословные реплики: сначала сокращаем более ранние ответы, затем переносим их в резюме
+        while estimate_tokens(self._render_turns()) > HISTORY_TOKEN_BUDGET - SUMMARY_TOKEN_BUDGET:
+            older = [i for i in range(len(self.turns) - 1) if len(self.turns[i][1]) > OLDER_TURN_ANSWER_LENGTH]
+            if older:
+                question_text, answer_text, topic_text = self.turns[older[0]]
+                self.turns[older[0]] = (question_text, self._shorten(answer_text, OLDER_TURN_ANSWER_LENGTH), topic_text)
+            elif len(self.turns) > 1:
+                self._fold_oldest_turn()
+            else:
+                break
+
+        # Резюме ограничено своей частью бюджета, самые старые строки вытесняются первыми
+        while self.summary and estimate_tokens(self._render_summary()) > SUMMARY_TOKEN_BUDGET:
+            self.summary.pop(0)
+
+    def _render_summary(self) -> str:
+        return "Ранее обсуждалось:\n" + "\n".join(self.summary) if self.summary else ""
+
+    def _render_turns(self) -> str:
+        return "\n\n".join(f"Пользователь: {question}\nАссистент: {answer}" for question, answer, _ in self.turns)
+
+    def render_history(self) -> str:
+        """Формирует текст истории для промпта."""
+        return "\n\n".join(part for part in (self._render_summary(), self._render_turns()) if part)
+
+    def last_topic(self) -> str:
+        return self.turns[-1][2] if self.turns else ""
+
+
+class SessionStore:
+    """Ограниченное хранилище сессий в памяти с вытеснением по TTL и LRU."""
+
+    def __init__(self, ttl: float, max_sessions: int):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, ConversationSession]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self, now: float) -> None:
+        """Удаляет устаревшие сессии и самые давние при превышении лимита."""
+        # Сессии упорядочены по последнему обращению, устаревшие находятся в начале
+        while self._sessions:
+            oldest = next(iter(self._sessions.values()))
+            if now - oldest.last_access <= self.ttl and len(self._sessions) <= self.max_sessions:
+                break
+            self._sessions.popitem(last=False)
+
+    def get(self, session_id: str) -> Optional[ConversationSession]:
+        """Возвращает активную сессию и продлевает ее время жизни."""
+        now = time.time()
+        with self._lock:
+            self._evict(now)
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+                session.last_access = now
+            return session
+
+    @staticmethod
+    def new_session() -> ConversationSession:
+        """Создает сессию с новым идентификатором; в хранилище она попадает через add()."""
+        return ConversationSession(secrets.token_urlsafe(16))
+
+    def add(self, session: ConversationSession) -> None:
+        """Сохраняет сессию, вытесняя самые давние при превышении лимита."""
+        now = time.time()
+        with self._lock:
+            session.last_access = now
+            self._sessions[session.session_id] = session
+            self._sessions.move_to_end(session.session_id)
+            self._evict(now)
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._sessions
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._sessions.clear()
+
+
+session_store = SessionStore(SESSION_TTL, MAX_SESSIONS)
+
+
+# Параметры профилирования (дешевые настолько, чтобы держать включенными в продакшне)
+SLOW_REQUESTS_KEEP = int(os.getenv("TOU_SLOW_REQUESTS_KEEP", "20"))  # Сколько самых медленных запросов хранить
+SLOW_REQUESTS_WINDOW = int(os.getenv("TOU_SLOW_REQUESTS_WINDOW", "3600"))  # Окно хранения в секундах
+LOOP_LAG_INTERVAL = 0.5  # Период замера задержки event loop в секундах
+MAX_PROFILE_SECONDS = 60  # Максимальная длительность сеанса профилирования
+
+
+class SlowRequestLog:
+    """Скользящий буфер самых медленных запросов с разбивкой по этапам.
+
+    Окно хранения разбито на корзины (по умолчанию по минуте), в каждой хранится
+    top-K запросов за этот интервал. Снимок объединяет корзины, поэтому после
+    устаревания старых пиков в выдачу попадают запросы, которые в момент своего
+    поступления не входили в общий top-K.
+    """
+
+    def __init__(self, keep: int, window: float, bucket_size: float = 60):
+        self.keep = keep
+        self.window = window
+        self.bucket_size = bucket_size
+        self._buckets = deque()  # Пары [номер корзины, мин-куча (длительность, порядковый номер, запись)]
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def _evict_expired(self, now: float) -> None:
+        """Удаляет корзины, целиком вышедшие за окно хранения."""
+        while self._buckets and (self._buckets[0][0] + 1) * self.bucket_size <= now - self.window:
+            self._buckets.popleft()
+
+    def record(self, question: str, duration: float, stages: Dict[str, float], error: bool = False) -> None:
+        """Регистрирует запрос, если он попадает в число самых медленных в своей корзине."""
+        now = time.time()
+        bucket_id = int(now // self.bucket_size)
+        with self._lock:
+            self._evict_expired(now)
+            if not self._buckets or self._buckets[-1][0] != bucket_id:
+                self._buckets.append([bucket_id, []])
+            heap = self._buckets[-1][1]
+            if len(heap) >= self.keep and duration <= heap[0][0]:
+                return
+            self._counter += 1
+            item = (duration, self._counter, {
+                "timestamp": now,
+                "question": question[:100],
+                "total": round(duration, 4),
+                "error": error,
+                "stages": {name: round(value, 4) for name, value in stages.items()},
+            })
+            if len(heap) < self.keep:
+                heapq.heappush(heap, item)
+            else:
+                heapq.heapreplace(heap, item)
+
+    def snapshot(self) -> list:
+        """Возвращает записи за окно хранения, отсортированные от самой медленной."""
+        now = time.time()
+        with self._lock:
+            self._evict_expired(now)
+            items = [item for _, heap in self._buckets for item in heap
+                     if now - item[2]["timestamp"] <= self.window]
+        return [entry for _, _, entry in heapq.nlargest(self.keep, items)]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._buckets.clear()
+
+
+class EventLoopLagMonitor:
+    """Фоновый замер задержки event loop по опозданию периодического таймера."""
+
+    def __init__(self, interval: float, history: int = 120):
+        self.interval = interval
+        self._samples = deque(maxlen=history)  # Последние замеры задержки
+        self.max_lag = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - start - self.interval)
+            self._samples.append(lag)
+            if lag > self.max_lag:
+                self.max_lag = lag
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def reset(self) -> None:
+        """Сбрасывает накопленные замеры и максимум задержки."""
+        self._samples.clear()
+        self.max_lag = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        samples = list(self._samples)
+        if not samples:
+            return {"samples": 0}
+        ordered = sorted(samples)
+        return {
+            "samples": len(samples),
+            "last_ms": round(samples[-1] * 1000, 2),
+            "avg_ms": round(sum(samples) / len(samples) * 1000, 2),
+            "p99_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000, 2),
+            "max_ms": round(self.max_lag * 1000, 2),
+        }
+
+
+def sample_stack_profile(duration: float, interval: float) -> str:
+    """Сэмплирующий профайлер всех потоков процесса.
+
+    Возвращает стеки в формате collapsed (flamegraph.pl, speedscope):
+    одна строка на уникальный стек, кадры через ';', в конце число сэмплов.
+    """
+    own_thread = threading.get_ident()
+    thread_names: Dict[int, str] = {}
+    labels: Dict[Tuple[Any, int], str] = {}  # Подписи кадров по (код, строка), чтобы не форматировать повторно
+    counts: Counter = Counter()
+    deadline = time.perf_counter() + duration
+
+    while time.perf_counter() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            # Обходим кадры напрямую: без чтения исходников через linecache
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                key = (code, frame.f_lineno)
+                label = labels.get(key)
+                if label is None:
+                    label = f"{code.co_name}({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+                    labels[key] = label
+                frames.append(label)
+                frame = frame.f_back
+            # Имя потока ищем при первой встрече: потоки пула могут стартовать во время профилирования
+            name = thread_names.get(thread_id)
+            if name is None:
+                thread = threading._active.get(thread_id)
+                name = (thread.name if thread is not None else str(thread_id)).replace(" ", "_")
+                thread_names[thread_id] = name
+            frames.append(name)
+            counts[";".join(reversed(frames))] += 1
+        # Не спим дольше оставшегося времени профилирования
+        time.sleep(max(0.0, min(interval, deadline - time.perf_counter())))
+
+    return "\n".join(f"{stack} {count}" for stack, count in counts.most_common())
+
+
+def executor_stats() -> Dict[str, int]:
+    """Состояние пула потоков AI запросов: размер очереди и число потоков."""
+    work_queue = getattr(executor, "_work_queue", None)
+    return {
+        "max_workers": getattr(executor, "_max_workers", 0),
+        "threads": len(getattr(executor, "_threads", ())),
+        "queued": work_queue.qsize() if work_queue is not None else 0,
+    }
+
+
+def is_admin_key(api_key: Optional[str]) -> bool:
+    """Проверка административного ключа."""
+    return bool(api_key) and api_key == os.getenv("ADMIN_API_KEY", "admin_key_default")
+
+
+slow_requests = SlowRequestLog(SLOW_REQUESTS_KEEP, SLOW_REQUESTS_WINDOW)
+loop_lag_monitor = EventLoopLagMonitor(LOOP_LAG_INTERVAL)
+profile_lock = threading.Lock()  # Одновременно допускается только один сеанс профилирования
 
 
 # Инициализация FastAPI с заголовками и метаданными
@@ -442,10 +853,22 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+async def start_loop_lag_monitor():
+    loop_lag_monitor.start()
+
+
+@app.on_event("shutdown")
+async def stop_loop_lag_monitor():
+    loop_lag_monitor.stop()
+
+
 class QueryRequest(BaseModel):
     """Модель запроса для эндпоинта /api/ask"""
     question: str
     api_key: Optional[str] = None
+    session_id: Optional[str] = None
+    start_session: bool = False  # Начать новую сессию диалога, если session_id не передан
 
 
 @app.get("/api/health")
@@ -455,6 +878,7 @@ async def health():
         "status": "ok",
         "timestamp": time.time(),
         "cache_size": len(response_cache),
+        "sessions": len(session_store),
         "version": "2.1.0"
     }
 
@@ -471,21 +895,48 @@ async def ask_ai(req: QueryRequest, x_api_key: Optional[str] = Header(None)):
     # Используем API ключ из заголовка или из тела запроса
     api_key = x_api_key or req.api_key
 
+    start_time = time.time()
+    stages: Dict[str, float] = {}
+    failed = True
     try:
-        start_time = time.time()
-        answer = await get_ai_answer_async(req.question, api_key)
+        # Сессия используется только по запросу клиента; запросы без нее остаются без состояния
+        session = session_store.get(req.session_id) if req.session_id else None
+        if session is None and (req.session_id or req.start_session):
+            # Новая сессия сохраняется только после первой успешной реплики
+            session = session_store.new_session()
+
+        # Реплики одной сессии обрабатываются последовательно, чтобы история не перемешивалась
+        async with (session.lock if session is not None else contextlib.nullcontext()):
+            # История нужна только уточняющим вопросам; самостоятельные используют общий кеш
+            history = ""
+            topic = None
+            search_query = None
+            if session is not None and session.turns and is_followup_question(req.question, knowledge_cache.has_relevant_sections(req.question)):
+                history = session.render_history()
+                # Тема наследуется по цепочке уточнений, поэтому поисковый запрос не растет
+                topic = session.last_topic()
+                search_query = f"{topic} {req.question}"
+
+            answer, success = await get_ai_answer_async(req.question, api_key, stages, history, search_query)
+            # Ошибки не попадают в историю, как и в кеш ответов
+            if success and session is not None:
+                session.add_turn(req.question, answer, topic)
+                if session.session_id not in session_store:
+                    session_store.add(session)
         processing_time = time.time() - start_time
         
         # Проверяем, был ли ответ взят из кеша
-        cache_key = get_cache_key(preprocess_query(req.question), knowledge_cache.get()[1])
+        cache_key = get_cache_key(preprocess_query(req.question), knowledge_cache.get()[1], history)
         is_cached = cache_key in response_cache and is_cache_valid(response_cache[cache_key][1])
 
+        failed = not success
         return JSONResponse(
             status_code=200,
             content={
                 "answer": answer,
                 "processing_time": round(processing_time, 2),
-                "cached": is_cached
+                "cached": is_cached,
+                "session_id": session.session_id if session is not None and session.session_id in session_store else None
             }
         )
     except ValueError as e:
@@ -506,17 +957,22 @@ async def ask_ai(req: QueryRequest, x_api_key: Optional[str] = Header(None)):
                 "error": True
             }
         )
+    finally:
+        # Неудачные запросы тоже попадают в журнал: среди них часто самые медленные
+        slow_requests.record(req.question, time.time() - start_time, stages, failed)
 
 
 # Эндпоинт для очистки кэша (защищенный паролем для продакшна)
 @app.post("/api/clear-cache")
 async def clear_cache(api_key: Optional[str] = Header(None)):
-    """Очистка кеша ответов (для разработки и администрирования)"""
+    """Очистка кеша ответов и сессий диалога (для разработки и администрирования)"""
     global response_cache
-    if api_key and api_key == os.getenv("ADMIN_API_KEY", "admin_key_default"):
+    if is_admin_key(api_key):
         old_size = len(response_cache)
+        old_sessions = len(session_store)
         response_cache.clear()
-        return {"status": "Кеш очищен", "old_size": old_size, "timestamp": time.time()}
+        session_store.clear()
+        return {"status": "Кеш очищен", "old_size": old_size, "old_sessions": old_sessions, "timestamp": time.time()}
     else:
         return JSONResponse(
             status_code=401,
@@ -524,6 +980,54 @@ async def clear_cache(api_key: Optional[str] = Header(None)):
         )
 
 
+# Эндпоинт сэмплирующего профилирования (защищен тем же ключом, что и очистка кеша)
+@app.post("/api/admin/profile")
+async def profile(seconds: float = 5.0, interval_ms: float = 10.0, api_key: Optional[str] = Header(None)):
+    """Профилирование процесса в течение заданного времени, ответ в формате collapsed stacks"""
+    if not is_admin_key(api_key):
+        return JSONResponse(
+            status_code=401,
+            content={"status": "Недостаточно прав для этой операции"}
+        )
+    if seconds <= 0 or seconds > MAX_PROFILE_SECONDS or interval_ms < 1 or interval_ms > seconds * 1000:
+        return JSONResponse(
+            status_code=400,
+            content={"status": f"Длительность должна быть от 0 до {MAX_PROFILE_SECONDS}с, интервал от 1мс до длительности профилирования"}
+        )
+    if not profile_lock.acquire(blocking=False):
+        return JSONResponse(
+            status_code=409,
+            content={"status": "Профилирование уже выполняется"}
+        )
+    try:
+        # Отдельный поток, чтобы не блокировать event loop и не занимать пул AI запросов
+        stacks = await asyncio.to_thread(sample_stack_profile, seconds, interval_ms / 1000)
+    finally:
+        profile_lock.release()
+    return PlainTextResponse(stacks)
+
+
+# Эндпоинт статистики производительности: задержка event loop и самые медленные запросы
+@app.get("/api/admin/perf")
+async def perf_stats(reset: bool = False, api_key: Optional[str] = Header(None)):
+    """Задержка event loop, состояние пула потоков и самые медленные запросы"""
+    if not is_admin_key(api_key):
+        return JSONResponse(
+            status_code=401,
+            content={"status": "Недостаточно прав для этой операции"}
+        )
+    result = {
+        "timestamp": time.time(),
+        "event_loop_lag": loop_lag_monitor.stats(),
+        "executor": executor_stats(),
+        "slow_requests": slow_requests.snapshot(),
+    }
+    if reset:
+        slow_requests.clear()
+        loop_lag_monitor.reset()
+    return result
+
+
 # Монтирование статических файлов фронтенда если они доступны
 frontend_dist = os.path.join(os.path.dirname(__file__), '..', 'frontend', 'dist')
 if os.environ.get("TOU_SERVE_FRONTEND") == "1" or ("--serve-frontend" in sys.argv):
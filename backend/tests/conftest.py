@@ -0,0 +1,5 @@
+import os
+import sys
+
+# main.py лежит в каталоге backend и импортируется как модуль верхнего уровня
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
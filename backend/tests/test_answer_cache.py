@@ -0,0 +1,39 @@
+import types
+
+import pytest
+
+import main
+
+
+class StubLLM:
+    def __init__(self, reply):
+        self.reply = reply
+        self.calls = 0
+
+    def invoke(self, prompt):
+        self.calls += 1
+        return types.SimpleNamespace(content=self.reply)
+
+
+@pytest.fixture
+def llm(monkeypatch):
+    stub = StubLLM("")
+    monkeypatch.setattr(main.llm_manager, "get_llm", lambda api_key=None: stub)
+    monkeypatch.setattr(main, "response_cache", {})
+    return stub
+
+
+def test_fallback_answer_is_not_cached(llm):
+    first = main.cached_ai_answer("База знаний", "hash", "Где библиотека?")
+    second = main.cached_ai_answer("База знаний", "hash", "Где библиотека?")
+    assert first[1] is False and second[1] is False
+    assert llm.calls == 2
+    assert main.response_cache == {}
+
+
+def test_successful_answer_is_served_from_cache(llm):
+    llm.reply = "Библиотека находится в главном корпусе."
+    first = main.cached_ai_answer("База знаний", "hash", "Где библиотека?")
+    second = main.cached_ai_answer("База знаний", "hash", "Где библиотека?")
+    assert first == second == (llm.reply, True)
+    assert llm.calls == 1
@@ -0,0 +1,87 @@
+import pytest
+
+from main import HISTORY_TOKEN_BUDGET, ConversationSession, SessionStore, estimate_tokens, is_followup_question
+
+
+def long_answer(index):
+    return (f"1. **Корпус {index}** расположен на улице Ломова, вход со двора.\n"
+            f"2. Работает с 9:00 до 18:00 по будням.\n" + "Подробности. " * 40)
+
+
+def test_numbered_answer_is_summarized_without_list_markers():
+    line = ConversationSession._summarize_turn("Где корпус?", long_answer(1))
+    assert line.startswith("- Где корпус? → Корпус 1 расположен на улице Ломова")
+    assert "**" not in line
+
+
+def test_history_keeps_summary_within_budget():
+    session = ConversationSession("test")
+    for index in range(8):
+        session.add_turn(f"Вопрос номер {index}?", long_answer(index))
+
+    assert estimate_tokens(session.render_history()) <= HISTORY_TOKEN_BUDGET
+    assert len(session.turns) == 3
+    assert len(session.summary) >= 3
+    # Последний ответ хранится полнее, чем более ранние
+    assert len(session.turns[-1][1]) > len(session.turns[0][1])
+
+
+@pytest.mark.parametrize("question", [
+    "а во сколько?",
+    "А когда она открыта?",
+    "а в субботу?",
+    "Расскажи о нем",
+    "Сколько это стоит?",
+    "когда?",
+])
+def test_followup_questions(question):
+    assert is_followup_question(question)
+
+
+@pytest.mark.parametrize("question", [
+    "Где находится библиотека?",
+    "Какие есть факультеты и где они находятся?",
+    "Что это за университет?",
+    "Какие документы нужны для поступления и где их сдавать?",
+    "Сколько стоит обучение на IT?",
+])
+def test_standalone_questions(question):
+    assert not is_followup_question(question)
+
+
+def test_question_matching_knowledge_is_standalone():
+    assert not is_followup_question("Когда она открыта, библиотека?", has_topic=True)
+
+
+def test_followups_inherit_topic_of_original_question():
+    session = ConversationSession("test")
+    session.add_turn("Где библиотека?", "Библиотека находится в главном корпусе.")
+    session.add_turn("А когда она открыта?", "С 9:00 до 18:00 по будням.", session.last_topic())
+    session.add_turn("а в субботу?", "В субботу с 10:00 до 14:00.", session.last_topic())
+    assert session.last_topic() == "Где библиотека?"
+
+
+def test_long_question_is_truncated_to_budget():
+    session = ConversationSession("test")
+    session.add_turn("Вопрос " * 1000, long_answer(1))
+    assert estimate_tokens(session.render_history()) <= HISTORY_TOKEN_BUDGET
+
+
+def test_new_session_is_stored_only_when_added():
+    store = SessionStore(ttl=1800, max_sessions=10)
+    session = store.new_session()
+    assert store.get(session.session_id) is None
+    store.add(session)
+    assert store.get(session.session_id) is session
+    assert len(store) == 1
+
+
+def test_store_evicts_least_recently_used_session():
+    store = SessionStore(ttl=1800, max_sessions=2)
+    first, second, third = (store.new_session() for _ in range(3))
+    store.add(first)
+    store.add(second)
+    store.get(first.session_id)
+    store.add(third)
+    assert second.session_id not in store
+    assert first.session_id in store and third.session_id in store
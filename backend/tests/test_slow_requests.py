@@ -0,0 +1,77 @@
+import pytest
+
+import main
+from main import SlowRequestLog
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Управляемые часы для проверки окна хранения."""
+    now = [1_000_000.0]
+    monkeypatch.setattr(main.time, "time", lambda: now[0])
+    return now
+
+
+def totals(log):
+    return [entry["total"] for entry in log.snapshot()]
+
+
+def test_keeps_slowest_requests_sorted(clock):
+    log = SlowRequestLog(keep=3, window=3600)
+    for duration in [1, 5, 2, 4, 3]:
+        log.record("вопрос", duration, {"llm": duration / 2})
+    assert totals(log) == [5, 4, 3]
+    assert log.snapshot()[0]["stages"] == {"llm": 2.5}
+
+
+def test_slower_request_replaces_fastest(clock):
+    log = SlowRequestLog(keep=2, window=3600)
+    log.record("a", 1, {})
+    log.record("b", 2, {})
+    log.record("c", 3, {})
+    assert [entry["question"] for entry in log.snapshot()] == ["c", "b"]
+
+
+def test_expired_spike_does_not_block_new_requests(clock):
+    log = SlowRequestLog(keep=3, window=10, bucket_size=1)
+    for duration in [30, 31, 32]:
+        log.record("пик", duration, {})
+    clock[0] += 100
+    log.record("новый", 5, {})
+    log.record("новый", 6, {})
+    assert totals(log) == [6, 5]
+
+
+def test_requests_hidden_by_old_spike_reappear_after_expiry(clock):
+    log = SlowRequestLog(keep=2, window=120, bucket_size=60)
+    log.record("пик", 30, {})
+    log.record("пик", 31, {})
+    clock[0] += 60
+    log.record("обычный", 5, {})
+    log.record("обычный", 4, {})
+    assert totals(log) == [31, 30]
+    clock[0] += 90
+    assert totals(log) == [5, 4]
+
+
+def test_clear(clock):
+    log = SlowRequestLog(keep=2, window=3600)
+    log.record("a", 1, {})
+    log.clear()
+    assert log.snapshot() == []
+
+
+def test_failed_requests_are_marked(clock):
+    log = SlowRequestLog(keep=2, window=3600)
+    log.record("ошибка", 30, {"executor_wait": 29.5}, error=True)
+    log.record("успех", 1, {})
+    assert [entry["error"] for entry in log.snapshot()] == [True, False]
+
+
+def test_loop_lag_reset_clears_max():
+    monitor = main.EventLoopLagMonitor(interval=0.5)
+    monitor._samples.append(0.2)
+    monitor.max_lag = 0.2
+    monitor.reset()
+    assert monitor.max_lag == 0.0
+    assert monitor.stats() == {"samples": 0}
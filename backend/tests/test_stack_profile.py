@@ -0,0 +1,24 @@
+import threading
+import time
+
+from main import sample_stack_profile
+
+
+def test_collapsed_stacks_name_threads_started_during_profiling():
+    def start_worker():
+        time.sleep(0.05)
+        threading.Thread(target=time.sleep, args=(0.2,), name="late worker").start()
+
+    threading.Thread(target=start_worker).start()
+    output = sample_stack_profile(0.15, 0.005)
+
+    stacks = dict(line.rsplit(" ", 1) for line in output.splitlines())
+    late = [stack for stack in stacks if stack.startswith("late_worker;")]
+    assert late and all(int(stacks[stack]) > 0 for stack in late)
+    assert all(";" in stack for stack in stacks)
+
+
+def test_long_interval_does_not_outlast_duration():
+    start = time.perf_counter()
+    sample_stack_profile(0.05, 3600)
+    assert time.perf_counter() - start < 1
@@ -2,7 +2,7 @@ import { useState, useEffect, useRef, useCallback, useMemo, memo } from "react"
 import "./App.css"
 
 type Message = { role: "user" | "assistant"; content: string }
-type Chat = { id: string; title: string; messages: Message[] }
+type Chat = { id: string; title: string; messages: Message[]; sessionId?: string }
 
 const LOGO = "/tou_logo_blue.png"
 
@@ -589,6 +589,7 @@ export default function App() {
         },
         body: JSON.stringify({ 
           question: userMsg.content, 
+          ...(activeChat.sessionId ? { session_id: activeChat.sessionId } : { start_session: true }),
           ...(apiKey ? { api_key: apiKey } : {})
         }),
         signal: controller.signal
@@ -614,6 +615,7 @@ export default function App() {
             ? { 
                 ...chat, 
                 messages: [...chat.messages, aiMsg], 
+                sessionId: data?.session_id || chat.sessionId,
                 title: chat.title === "Новый чат" ? getChatTitle([userMsg, ...chat.messages]) : chat.title 
               }
             : chat
@@ -645,7 +647,7 @@ export default function App() {
     } finally {
       setLoading(false)
     }
-  }, [input, apiKey, loading, activeChat.id])
+  }, [input, apiKey, loading, activeChat.id, activeChat.sessionId])
 
   // Создание нового чата
   const handleNewChat = useCallback(() => {